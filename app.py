@@ -1,71 +1,115 @@
+import io
 import os
 import hmac
 import hashlib
 import logging
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
+import msgspec
+import orjson
 import requests
-from urllib.parse import urlparse
+import tiktoken
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from llm_cache import LLMCache, LRUBackend, RedisBackend, cache_key
+from payloads import pull_request_event_decoder
 
 
 load_dotenv()
 
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+class OrJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
 
 FIREWORKS_API_KEY = os.getenv("FIREWORKS_API_KEY")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
+WEBHOOK_SECRET_BYTES = GITHUB_WEBHOOK_SECRET.encode() if GITHUB_WEBHOOK_SECRET else None
+SIGNATURE_LENGTH = len("sha256=") + 64
+FIREWORKS_MAX_CONCURRENCY = int(os.getenv("FIREWORKS_MAX_CONCURRENCY", 8))
+REDIS_URL = os.getenv("REDIS_URL")
+# Temperature 0 keeps summaries deterministic, which is what makes them safe to cache.
+SUMMARY_TEMPERATURE = float(os.getenv("SUMMARY_TEMPERATURE", 0))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH")
+# Below this size a one-line difference matters, so only the exact cache is used.
+SEMANTIC_CACHE_MIN_CHARS = int(os.getenv("SEMANTIC_CACHE_MIN_CHARS", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+TASK_QUEUE = os.getenv("TASK_QUEUE", "thread")
+DELIVERY_TTL = int(os.getenv("DELIVERY_TTL", 3600))
+# A claim first only lasts long enough for one job (RQ jobs time out after SUMMARY_JOB_TIMEOUT).
+# It is extended to DELIVERY_TTL once the comment is posted, so a job lost to a worker restart
+# or redeploy does not block GitHub's redelivery for an hour.
+SUMMARY_JOB_TIMEOUT = 600
+DELIVERY_CLAIM_TTL = int(os.getenv("DELIVERY_CLAIM_TTL", 900))
+# (connect, read) seconds; with streaming, the read timeout bounds the gap between chunks.
+HTTP_TIMEOUT = (3.05, 30)
+MAX_DIFF_BYTES = int(os.getenv("MAX_DIFF_BYTES", 2 * 1024 * 1024))
+MAX_CHUNK_TOKENS = int(os.getenv("MAX_CHUNK_TOKENS", 6000))
+# Larger diffs are not kept for conditional requests, so the ETag cache stays small.
+ETAG_CACHE_MAX_DIFF_BYTES = 256 * 1024
+ETAG_CACHE_TTL = 86400
+# GitHub pull_request payloads are well under 1 MiB; Flask answers 413 to anything larger
+# before the body is read, hashed, or parsed.
+MAX_WEBHOOK_BYTES = int(os.getenv("MAX_WEBHOOK_BYTES", 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_WEBHOOK_BYTES
 
+FILE_BOUNDARY_RE = re.compile(r'(?m)^(?=diff --git )')
+DIFF_PATH_RE = re.compile(r'diff --git a/.* b/(.+)')
+GENERATED_FILE_RE = re.compile(
+    r'(?i)((package-lock\.json|yarn\.lock|pnpm-lock\.yaml|Cargo\.lock|Gemfile\.lock|poetry\.lock|Pipfile\.lock|go\.sum'
+    r'|\.min\.(js|css)|\.svg)$|(^|/)(vendor|node_modules)/)'
+)
+BINARY_PATCH_RE = re.compile(r'(?m)^(Binary files .* differ|GIT binary patch)$')
+GENERATED_ONLY_THRESHOLD = 0.95
+GENERATED_ONLY_SUMMARY = "Auto-generated, vendored, or binary changes only; no semantic review needed."
+PR_ACTIONS = frozenset({'opened', 'synchronize', 'reopened'})
+ACTION_PEEK_RE = re.compile(rb'\s*\{\s*"action"\s*:\s*"([a-z_]+)"')
+PART_UNAVAILABLE_SUMMARY = "_Summary unavailable for this part of the diff._"
+DIFF_TOO_LARGE_SUMMARY = "This diff is too large to summarize automatically; please review it manually."
 
-def verify_signature(payload, signature):
-    if not GITHUB_WEBHOOK_SECRET:
-        logger.info("No webhook secret set, skipping signature verification")
-        return True
-    mac = hmac.new(GITHUB_WEBHOOK_SECRET.encode(), msg=payload, digestmod=hashlib.sha256)
-    expected_signature = "sha256=" + mac.hexdigest()
-    is_valid = hmac.compare_digest(expected_signature, signature)
-    logger.debug(f"Signature verification: expected={expected_signature}, received={signature}, valid={is_valid}")
-    return is_valid
-
-def fetch_pr_diff(owner, repo, pull_number):
-    logger.info(f"Fetching diff for {owner}/{repo}/pull/{pull_number}")
-    headers = {
-        'Accept': 'application/vnd.github.v3.diff',
-        'Authorization': f'token {GITHUB_TOKEN}',
-    }
-    url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}"
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    diff_text = response.text
-    logger.debug(f"Diff fetched, length={len(diff_text)}")
-    return diff_text
-
-def chunk_diff(diff_text, max_chunk_size=50000):
-    logger.info(f"Chunking diff of length {len(diff_text)}")
-    chunks = []
-    current_chunk = ""
-    lines = diff_text.splitlines()
-    for line in lines:
-        if len(current_chunk) + len(line) + 1 > max_chunk_size:
-            if current_chunk:
-                chunks.append(current_chunk)
-            current_chunk = line + "\n"
-        else:
-            current_chunk += line + "\n"
-    if current_chunk:
-        chunks.append(current_chunk)
-    logger.debug(f"Created {len(chunks)} chunks")
-    return chunks
-
-def summarize_diff_with_dobby(diff_text):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {FIREWORKS_API_KEY}", "Content-Type": "application/json"}
-    prompt = f"""
-**Role:** You are an expert software developer.
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_DIFF_HEADERS = {'Accept': 'application/vnd.github.v3.diff'}
+GITHUB_JSON_BODY_HEADERS = {'Content-Type': 'application/json'}
+FIREWORKS_URL = "https://api.fireworks.ai/inference/v1/chat/completions"
+SUMMARY_MODEL = "accounts/sentientfoundation/models/dobby-unhinged-llama-3-3-70b-new"
+# Size-based routing: diffs under SMALL_DIFF_TOKENS go to SMALL_SUMMARY_MODEL, under
+# MEDIUM_DIFF_TOKENS to MEDIUM_SUMMARY_MODEL, and anything larger to Dobby-70.
+# Both tiers default to Dobby-70, so routing only changes cost once a cheaper model is set.
+SMALL_SUMMARY_MODEL = os.getenv("SMALL_SUMMARY_MODEL", SUMMARY_MODEL)
+MEDIUM_SUMMARY_MODEL = os.getenv("MEDIUM_SUMMARY_MODEL", SUMMARY_MODEL)
+SMALL_DIFF_TOKENS = int(os.getenv("SMALL_DIFF_TOKENS", 4000))
+MEDIUM_DIFF_TOKENS = int(os.getenv("MEDIUM_DIFF_TOKENS", 20000))
+FIREWORKS_BASE_DATA = {
+    "model": SUMMARY_MODEL,
+    "max_tokens": 1024,
+    "temperature": SUMMARY_TEMPERATURE,
+    "stream": True,
+}
+# Sent as a separate leading system message and never interpolated, so every request
+# shares the same prefix and Fireworks can reuse its KV cache across chunks.
+SYSTEM_PROMPT = """**Role:** You are an expert software developer.
 **Task:** Summarize the provided GitHub pull request diff.
 **Goal:** Generate a concise, high-quality summary formatted with clear markdown headings and bullet points.
 
@@ -88,71 +132,566 @@ def summarize_diff_with_dobby(diff_text):
 
 ## Files Changed
 -   List the key files that were modified.
+"""
+COMBINE_SYSTEM_PROMPT = """**Role:** You are an expert software developer.
+**Task:** Merge partial summaries of one GitHub pull request diff into a single summary.
+**Goal:** Generate a concise, high-quality summary formatted with clear markdown headings and bullet points.
 
----
-**DIFF:**
-{diff_text}
----
+**Instructions:**
+-   Each partial summary covers a different part of the same diff.
+-   Combine them without repeating points, keeping the structure: Summary, Key Changes, Potential Risks, Verification, Files Changed.
+-   Be brief and to the point.
 """
-    data = {
-        "model": "accounts/sentientfoundation/models/dobby-unhinged-llama-3-3-70b-new",
-        "max_tokens": 1024,
-        "messages": [{"role": "user", "content": prompt}]
+# Part of the whole-diff cache key, so editing either prompt invalidates cached summaries.
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + COMBINE_SYSTEM_PROMPT).encode()).hexdigest()[:12]
+# Whole-diff cache entries are JSON [model, summary]; bump when that layout changes.
+SUMMARY_CACHE_FORMAT = 2
+
+
+def create_session(headers, retry_methods=Retry.DEFAULT_ALLOWED_METHODS):
+    session = requests.Session()
+    session.headers.update(headers)
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=retry_methods,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retries))
+    return session
+
+# POST is only retried for Fireworks: retrying a GitHub comment POST could post it twice.
+gh_session = create_session({
+    'Authorization': f'token {GITHUB_TOKEN}',
+    'Accept': 'application/vnd.github.v3+json',
+})
+fw_session = create_session(
+    {"Authorization": f"Bearer {FIREWORKS_API_KEY}", "Content-Type": "application/json"},
+    retry_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+)
+
+# Caps in-flight Fireworks requests across all concurrent webhooks in this process.
+fireworks_slots = threading.BoundedSemaphore(FIREWORKS_MAX_CONCURRENCY)
+
+
+def create_redis_client():
+    if not REDIS_URL:
+        return None
+    import redis
+    return redis.Redis.from_url(REDIS_URL)
+
+redis_client = create_redis_client()
+
+
+def create_llm_cache():
+    if redis_client is not None:
+        logger.info("Using Redis LLM response cache")
+        return LLMCache(RedisBackend(redis_client))
+    return LLMCache(LRUBackend(maxsize=512))
+
+llm_cache = create_llm_cache()
+
+
+def create_semantic_cache():
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    from semantic_cache import SemanticCache
+    logger.info("Using semantic cache for near-duplicate diffs")
+    return SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD, index_path=SEMANTIC_CACHE_PATH,
+                         prompt_version=PROMPT_VERSION)
+
+semantic_cache = create_semantic_cache()
+
+
+# owner/repo/number -> JSON [ETag, diff text] for conditional diff requests; shared
+# across workers through Redis when it is configured.
+def create_etag_cache():
+    if redis_client is not None:
+        return RedisBackend(redis_client, ttl=ETAG_CACHE_TTL, prefix="etag:")
+    return LRUBackend(maxsize=256)
+
+etag_cache = create_etag_cache()
+
+# Webhooks are acknowledged immediately and summarized in the background, so GitHub's
+# 10s delivery timeout never races the LLM. With TASK_QUEUE=rq the work goes to a Redis
+# queue drained by separate `rq worker` processes; otherwise it runs on threads in this process.
+def create_job_queue():
+    if TASK_QUEUE != "rq":
+        return None
+    if redis_client is None:
+        raise RuntimeError("TASK_QUEUE=rq requires REDIS_URL")
+    from rq import Queue
+    logger.info("Queueing PR summaries on Redis queue 'pr-summaries'")
+    return Queue("pr-summaries", connection=redis_client)
+
+job_queue = create_job_queue()
+webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+# Fallback for claim_delivery when Redis is not configured: key -> expiry (monotonic seconds).
+claimed_deliveries = {}
+claimed_lock = threading.Lock()
+# Whole-diff cache key -> Future of the summary being computed, so concurrent requests
+# for an identical diff share one set of Fireworks calls.
+inflight_summaries = {}
+inflight_summaries_lock = threading.Lock()
+
+
+def verify_signature(payload, signature):
+    if not WEBHOOK_SECRET_BYTES:
+        logger.info("No webhook secret set, skipping signature verification")
+        return True
+    # Public-structure checks only (prefix + 64 hex chars), so junk is rejected
+    # before hashing the body without leaking anything about the secret.
+    if not signature or len(signature) != SIGNATURE_LENGTH or not signature.startswith("sha256="):
+        return False
+    try:
+        received = bytes.fromhex(signature[len("sha256="):])
+    except ValueError:
+        return False
+    expected = hmac.digest(WEBHOOK_SECRET_BYTES, payload, "sha256")
+    return hmac.compare_digest(expected, received)
+
+class DiffTooLargeError(Exception):
+    pass
+
+def fetch_pr_diff(owner, repo, pull_number):
+    logger.info("Fetching diff for %s/%s/pull/%s", owner, repo, pull_number)
+    headers = GITHUB_DIFF_HEADERS
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pull_number}"
+    pr_key = f"{owner}/{repo}/{pull_number}"
+    cached = etag_cache.get(pr_key)
+    if cached:
+        cached = orjson.loads(cached)
+        headers = {**GITHUB_DIFF_HEADERS, 'If-None-Match': cached[0]}
+    with gh_session.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+        if response.status_code == 304:
+            logger.debug("Diff not modified, using cached copy")
+            return cached[1]
+        response.raise_for_status()
+        buf = bytearray()
+        for block in response.iter_content(chunk_size=64 * 1024):
+            buf.extend(block)
+            if len(buf) > MAX_DIFF_BYTES:
+                raise DiffTooLargeError(f"Diff exceeds {MAX_DIFF_BYTES} bytes")
+        etag = response.headers.get('ETag')
+    diff_size = len(buf)
+    diff_text = buf.decode('utf-8', 'replace')
+    del buf
+    if etag and diff_size <= ETAG_CACHE_MAX_DIFF_BYTES:
+        etag_cache.set(pr_key, orjson.dumps([etag, diff_text]).decode())
+    logger.debug("Diff fetched, length=%d", len(diff_text))
+    return diff_text
+
+def split_diff_by_file(diff_text):
+    segments = [segment for segment in FILE_BOUNDARY_RE.split(diff_text) if segment]
+    if segments and not segments[-1].endswith("\n"):
+        segments[-1] += "\n"
+    return segments
+
+@lru_cache(maxsize=None)
+def token_encoding():
+    # tiktoken downloads the BPE file on first use unless it is already in TIKTOKEN_CACHE_DIR,
+    # so load it on demand and fall back to estimating when it cannot be fetched.
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("tiktoken encoding unavailable, estimating tokens from length: %s", e)
+        return None
+
+@lru_cache(maxsize=4096)
+def line_tokens(line):
+    # Diff context lines repeat a lot, so token counts are memoized per line.
+    encoding = token_encoding()
+    if encoding is None:
+        return len(line) // 4 + 1
+    return len(encoding.encode(line, disallowed_special=()))
+
+def count_tokens(text):
+    return sum(line_tokens(line) for line in io.StringIO(text))
+
+def pack_lines(text, max_chunk_tokens):
+    chunks = []
+    current_lines = []
+    current_tokens = 0
+    for line in io.StringIO(text):
+        if not line.endswith("\n"):
+            line += "\n"
+        tokens = line_tokens(line)
+        if current_lines and current_tokens + tokens > max_chunk_tokens:
+            chunks.append("".join(current_lines))
+            current_lines = []
+            current_tokens = 0
+        current_lines.append(line)
+        current_tokens += tokens
+    if current_lines:
+        chunks.append("".join(current_lines))
+    return chunks
+
+# Returns the chunks and the diff's total token count, so callers need not tokenize it again.
+def chunk_diff(diff_text, max_chunk_tokens=MAX_CHUNK_TOKENS):
+    logger.info("Chunking diff of length %d", len(diff_text))
+    chunks = []
+    bins = []
+    segments = [(count_tokens(segment), segment) for segment in split_diff_by_file(diff_text)]
+    # First-fit decreasing: keep each file's diff whole and pack files into as few chunks as possible.
+    for tokens, segment in sorted(segments, key=lambda item: item[0], reverse=True):
+        if tokens > max_chunk_tokens:
+            chunks.extend(pack_lines(segment, max_chunk_tokens))
+            continue
+        for b in bins:
+            if b[0] + tokens <= max_chunk_tokens:
+                b[0] += tokens
+                b[1].append(segment)
+                break
+        else:
+            bins.append([tokens, [segment]])
+    chunks.extend("".join(files) for _, files in bins)
+    logger.debug("Created %d chunks", len(chunks))
+    return chunks, sum(tokens for tokens, _ in segments)
+
+def diff_path(segment):
+    match = DIFF_PATH_RE.match(segment)
+    return match.group(1) if match else None
+
+# Only trailing whitespace is ignored: leading whitespace is significant in Python/YAML
+# and inner whitespace can sit inside string literals. Each hunk's old side (context and
+# removed lines) is compared with its new side (context and added lines), so moved or
+# swapped lines still count as a change.
+def is_whitespace_only(segment):
+    hunks = []
+    changed = False
+    for line in io.StringIO(segment):
+        if line.startswith("@@"):
+            hunks.append(([], []))
+            continue
+        if not hunks or line.startswith("\\"):
+            continue
+        old, new = hunks[-1]
+        text = line[1:].rstrip()
+        if line.startswith("-"):
+            old.append(text)
+            changed = True
+        elif line.startswith("+"):
+            new.append(text)
+            changed = True
+        else:
+            old.append(text)
+            new.append(text)
+    return changed and all(old == new for old, new in hunks)
+
+def is_ignorable_segment(segment):
+    path = diff_path(segment)
+    if path and GENERATED_FILE_RE.search(path):
+        return True
+    if BINARY_PATCH_RE.search(segment):
+        return True
+    return is_whitespace_only(segment)
+
+def strip_ignorable_files(diff_text):
+    segments = split_diff_by_file(diff_text)
+    kept = [segment for segment in segments if not is_ignorable_segment(segment)]
+    total_size = sum(len(segment) for segment in segments)
+    kept_size = sum(len(segment) for segment in kept)
+    ignored_ratio = (total_size - kept_size) / total_size if total_size else 0.0
+    return "".join(kept), ignored_ratio
+
+# Everything that decides the summary of a diff: the prompts, the routing tiers, the
+# chunk size and the temperature.
+def summary_cache_key(diff_sha):
+    fields = {
+        "format": SUMMARY_CACHE_FORMAT,
+        "prompt_version": PROMPT_VERSION,
+        "models": [SMALL_SUMMARY_MODEL, MEDIUM_SUMMARY_MODEL, SUMMARY_MODEL],
+        "routing_tokens": [SMALL_DIFF_TOKENS, MEDIUM_DIFF_TOKENS],
+        "max_chunk_tokens": MAX_CHUNK_TOKENS,
+        "temperature": SUMMARY_TEMPERATURE,
+        "diff_sha256": diff_sha,
     }
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
-    return response.json()['choices'][0]['message']['content']
+    return "summary:" + hashlib.sha256(orjson.dumps(fields, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def summarize_diff_with_dobby(diff_text):
+    key = summary_cache_key(hashlib.sha256(diff_text.encode()).hexdigest())
+    cached = llm_cache.get(key)
+    if cached is not None:
+        logger.info("Diff summary cache hit")
+        model, summary = orjson.loads(cached)
+        return summary, model
+    with inflight_summaries_lock:
+        future = inflight_summaries.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = inflight_summaries[key] = Future()
+    if not is_leader:
+        logger.info("Waiting for in-flight summary of an identical diff")
+        return future.result()
+    try:
+        summary, model, complete_summary = summarize_uncached_diff(diff_text)
+        # Summaries with unavailable parts are not cached so a redelivery can retry them.
+        if complete_summary:
+            llm_cache.set(key, orjson.dumps([model, summary]).decode())
+        future.set_result((summary, model))
+        return summary, model
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_summaries_lock:
+            inflight_summaries.pop(key, None)
+
+def summarize_uncached_diff(diff_text):
+    diff_text, ignored_ratio = strip_ignorable_files(diff_text)
+    if ignored_ratio > GENERATED_ONLY_THRESHOLD:
+        logger.info("Diff is %.0f%% generated or whitespace-only changes, skipping LLM", ignored_ratio * 100)
+        return GENERATED_ONLY_SUMMARY, None, True
+    chunks, diff_tokens = chunk_diff(diff_text)
+    model = select_model(diff_tokens)
+    if len(chunks) <= 1:
+        return summarize_chunk(diff_text, model=model), model, True
+    logger.info("Summarizing %d chunks with up to %d concurrent requests", len(chunks), FIREWORKS_MAX_CONCURRENCY)
+    tasks = [(i, summarize_chunk, (chunk, i, len(chunks), model)) for i, chunk in enumerate(chunks, 1)]
+    results = run_batch(tasks, FIREWORKS_MAX_CONCURRENCY)
+    errors = [error for _, _, error in results if error is not None]
+    if len(errors) == len(results):
+        raise errors[0]
+    parts = []
+    for i, summary, error in results:
+        if error is not None:
+            logger.warning("Failed to summarize part %d/%d: %s", i, len(chunks), error)
+            summary = PART_UNAVAILABLE_SUMMARY
+        parts.append(f"### Part {i}/{len(chunks)}\n\n{summary}")
+    partial_summaries = "\n\n---\n\n".join(parts)
+    try:
+        return combine_summaries(partial_summaries, model), model, not errors
+    except Exception as e:
+        logger.warning("Failed to combine %d partial summaries, posting them as-is: %s", len(chunks), e)
+        return partial_summaries, model, False
+
+# Runs (key, fn, args) tasks with at most max_concurrency in flight and returns
+# (key, result, error) tuples in task order; one failing task does not cancel the rest.
+def run_batch(tasks, max_concurrency):
+    def run(fn, args):
+        try:
+            return fn(*args), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(tasks)))) as executor:
+        futures = [(key, executor.submit(run, fn, args)) for key, fn, args in tasks]
+        return [(key, *future.result()) for key, future in futures]
+
+def select_model(diff_tokens):
+    if diff_tokens < SMALL_DIFF_TOKENS:
+        model = SMALL_SUMMARY_MODEL
+    elif diff_tokens < MEDIUM_DIFF_TOKENS:
+        model = MEDIUM_SUMMARY_MODEL
+    else:
+        model = SUMMARY_MODEL
+    logger.debug("Routing %d-token diff to %s", diff_tokens, model)
+    return model
+
+def summarize_chunk(diff_text, part=1, total=1, model=SUMMARY_MODEL):
+    label = f"**DIFF (part {part}/{total}):**" if total > 1 else "**DIFF:**"
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{label}\n{diff_text}"},
+    ]
+    return complete(messages, model, semantic_text=diff_text)
+
+def combine_summaries(partial_summaries, model=SUMMARY_MODEL):
+    messages = [
+        {"role": "system", "content": COMBINE_SYSTEM_PROMPT},
+        {"role": "user", "content": f"**PARTIAL SUMMARIES:**\n{partial_summaries}"},
+    ]
+    return complete(messages, model)
+
+def complete(messages, model=SUMMARY_MODEL, semantic_text=None):
+    data = {**FIREWORKS_BASE_DATA, "model": model, "messages": messages}
+    key = cache_key(model, messages, SUMMARY_TEMPERATURE)
+    summary = llm_cache.get(key)
+    if summary is not None:
+        logger.debug("LLM cache hit")
+        return summary
+    vectors = None
+    if semantic_cache is not None and semantic_text is not None and len(semantic_text) >= SEMANTIC_CACHE_MIN_CHARS:
+        vectors = semantic_cache.embed(semantic_text)
+        summary = semantic_cache.lookup(vectors, model)
+        if summary is not None:
+            return summary
+    summary = "".join(stream_completion(data))
+    llm_cache.set(key, summary)
+    if vectors is not None:
+        semantic_cache.add(vectors, model, summary)
+    return summary
+
+class FireworksStreamError(Exception):
+    pass
+
+def stream_completion(data):
+    with fireworks_slots, fw_session.post(FIREWORKS_URL, data=orjson.dumps(data), stream=True, timeout=HTTP_TIMEOUT) as response:
+        response.raise_for_status()
+        finished = False
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            event = line[len(b"data: "):]
+            if event == b"[DONE]":
+                finished = True
+                break
+            chunk = orjson.loads(event)
+            if 'error' in chunk:
+                raise FireworksStreamError(f"Fireworks stream error: {chunk['error']}")
+            choice = chunk['choices'][0]
+            if choice.get('finish_reason'):
+                finished = True
+            delta = choice['delta'].get('content')
+            if delta:
+                yield delta
+        # A stream closed early by a proxy or the server looks like a normal end;
+        # raise so the partial text is neither cached nor posted.
+        if not finished:
+            raise FireworksStreamError("Fireworks stream ended before the completion finished")
 
 
 def post_comment_to_pr(owner, repo, pull_number, comment):
-    logger.info(f"Posting comment to {owner}/{repo}/pull/{pull_number}")
-    headers = {
-        'Authorization': f'token {GITHUB_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-    }
-    url = f"https://api.github.com/repos/{owner}/{repo}/issues/{pull_number}/comments"
+    logger.info("Posting comment to %s/%s/pull/%s", owner, repo, pull_number)
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{pull_number}/comments"
     data = {'body': comment}
-    response = requests.post(url, headers=headers, json=data)
+    response = gh_session.post(url, headers=GITHUB_JSON_BODY_HEADERS, data=orjson.dumps(data), timeout=HTTP_TIMEOUT)
     response.raise_for_status()
     logger.debug("Comment posted successfully")
 
+def summarize_pr(owner, repo, pull_number):
+    try:
+        diff_text = fetch_pr_diff(owner, repo, pull_number)
+    except DiffTooLargeError as e:
+        logger.warning("Skipping summary for PR %s/%s/%s: %s", owner, repo, pull_number, e)
+        return DIFF_TOO_LARGE_SUMMARY, None
+    return summarize_diff_with_dobby(diff_text)
+
+# model is None when the summary was written without an LLM.
+def summary_header(model):
+    if model is None:
+        return "**PR Summary**"
+    name = "Dobby-70" if model == SUMMARY_MODEL else model.rsplit("/", 1)[-1]
+    return f"**PR Summary by {name}**"
+
+# True only for the first claim of key; the claim holds for DELIVERY_CLAIM_TTL seconds
+# until confirm_delivery extends it.
+def claim_delivery(key):
+    if redis_client is not None:
+        return bool(redis_client.set(key, "1", nx=True, ex=DELIVERY_CLAIM_TTL))
+    now = time.monotonic()
+    with claimed_lock:
+        if claimed_deliveries.get(key, 0) > now:
+            return False
+        for stale in [k for k, expires in claimed_deliveries.items() if expires <= now]:
+            del claimed_deliveries[stale]
+        claimed_deliveries[key] = now + DELIVERY_CLAIM_TTL
+        return True
+
+# Called once the comment is posted: repeat events for this commit are ignored for DELIVERY_TTL.
+def confirm_delivery(key):
+    if redis_client is not None:
+        try:
+            redis_client.set(key, "1", ex=DELIVERY_TTL)
+        except Exception as e:
+            logger.warning("Failed to extend delivery claim %s: %s", key, e)
+        return
+    with claimed_lock:
+        claimed_deliveries[key] = time.monotonic() + DELIVERY_TTL
+
+def release_delivery(key):
+    if redis_client is not None:
+        # Best effort: callers release while handling another error, which must not be masked.
+        try:
+            redis_client.delete(key)
+        except Exception as e:
+            logger.warning("Failed to release delivery claim %s: %s", key, e)
+        return
+    with claimed_lock:
+        claimed_deliveries.pop(key, None)
+
+def process_pr(owner, repo, pull_number, delivery_key):
+    logger.info("Processing PR %s/%s/%s", owner, repo, pull_number)
+    try:
+        summary, model = summarize_pr(owner, repo, pull_number)
+        comment = f"{summary_header(model)}:\n\n{summary}"
+        post_comment_to_pr(owner, repo, pull_number, comment)
+    except Exception as e:
+        logger.error("Error processing PR %s/%s/%s: %s", owner, repo, pull_number, e, exc_info=True)
+        # Let a redelivery of the same commit try again.
+        release_delivery(delivery_key)
+        return
+    confirm_delivery(delivery_key)
+    logger.info("PR %s/%s/%s processed successfully", owner, repo, pull_number)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {'llm_cache': llm_cache.stats()}
+    if semantic_cache is not None:
+        stats['semantic_cache'] = {'entries': len(semantic_cache.entries)}
+    return jsonify(stats), 200
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     logger.info("Received webhook request")
-    signature = request.headers.get('X-Hub-Signature-256')
-    if not verify_signature(request.data, signature):
-        logger.error("Signature verification failed")
-        return jsonify({'error': 'Signature mismatch'}), 403
-    
+    if request.content_length is not None and request.content_length > MAX_WEBHOOK_BYTES:
+        logger.warning("Rejected webhook body of %d bytes", request.content_length)
+        return jsonify({'error': 'Payload too large'}), 413
+
+    # Most deliveries are not pull_request events; drop them before hashing the body.
     event = request.headers.get('X-GitHub-Event')
-    logger.debug(f"Event type: {event}")
+    logger.debug("Event type: %s", event)
     if event != 'pull_request':
         logger.info("Ignored non-pull_request event")
         return jsonify({'message': 'Ignored event'}), 200
-    
-    payload = request.json
-    action = payload.get('action')
-    logger.debug(f"Action: {action}")
-    if action not in ['opened', 'synchronize', 'reopened']:
-        logger.info(f"Ignored action: {action}")
+
+    raw = request.get_data(cache=True)
+    signature = request.headers.get('X-Hub-Signature-256')
+    if not verify_signature(raw, signature):
+        logger.error("Signature verification failed")
+        return jsonify({'error': 'Signature mismatch'}), 403
+
+    # GitHub serializes "action" as the first key, so most ignored actions are
+    # rejected without parsing the full payload.
+    peeked = ACTION_PEEK_RE.match(raw)
+    if peeked and peeked.group(1).decode() not in PR_ACTIONS:
+        logger.info("Ignored action: %s", peeked.group(1).decode())
+        return jsonify({'message': 'Ignored action'}), 200
+
+    try:
+        payload = pull_request_event_decoder.decode(raw)
+    except msgspec.MsgspecError as e:
+        logger.error("Invalid pull_request payload: %s", e)
+        return jsonify({'error': 'Invalid payload'}), 400
+    action = payload.action
+    logger.debug("Action: %s", action)
+    if action not in PR_ACTIONS:
+        logger.info("Ignored action: %s", action)
         return jsonify({'message': 'Ignored action'}), 200
     
-    pr = payload.get('pull_request')
-    owner = pr['base']['repo']['owner']['login']
-    repo = pr['base']['repo']['name']
-    pull_number = pr['number']
-    logger.info(f"Processing PR {owner}/{repo}/{pull_number}")
-    
+    pr = payload.pull_request
+    owner = pr.base.repo.owner.login
+    repo = pr.base.repo.name
+    pull_number = pr.number
+    delivery_key = f"processed:{pr.node_id}:{pr.head.sha}"
+    if not claim_delivery(delivery_key):
+        logger.info("PR %s/%s/%s at %s already processed", owner, repo, pull_number, pr.head.sha)
+        return jsonify({'message': 'Already processed'}), 200
+    logger.info("Queueing PR %s/%s/%s", owner, repo, pull_number)
     try:
-        diff_text = fetch_pr_diff(owner, repo, pull_number)
-        summary = summarize_diff_with_dobby(diff_text)
-        comment = f"**PR Summary by Dobby-70**:\n\n{summary}"
-        post_comment_to_pr(owner, repo, pull_number, comment)
-        logger.info("Webhook processed successfully")
-        return jsonify({'message': 'Summary posted'}), 200
+        if job_queue is not None:
+            job_id = f"pr-{pr.base.repo.id}-{pull_number}-{pr.head.sha}"
+            job_queue.enqueue(process_pr, owner, repo, pull_number, delivery_key, job_id=job_id, job_timeout=SUMMARY_JOB_TIMEOUT)
+        else:
+            webhook_executor.submit(process_pr, owner, repo, pull_number, delivery_key)
     except Exception as e:
-        logger.error(f"Error processing webhook: {str(e)}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
+        logger.error("Failed to queue PR %s/%s/%s: %s", owner, repo, pull_number, e, exc_info=True)
+        # Nothing was queued, so let GitHub's redelivery claim this commit again.
+        release_delivery(delivery_key)
+        return jsonify({'error': 'Failed to queue summary'}), 503
+    return jsonify({'message': 'Summary queued'}), 202
 
 if __name__ == '__main__':
     port = int(os.getenv("PORT", 5000)) 
@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+# gevent workers yield during socket waits, so one worker can hold many webhook
+# deliveries and GitHub/Fireworks calls in flight at once.
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+# Without Redis the duplicate-event guard lives in each process, so a second worker
+# would summarize GitHub's redeliveries again. Run a single worker unless Redis is set.
+default_workers = multiprocessing.cpu_count() * 2 + 1 if os.getenv("REDIS_URL") else 1
+workers = int(os.getenv("WEB_CONCURRENCY", default_workers))
+worker_class = "gevent"
+worker_connections = 1000
+keepalive = 75
+timeout = 120
+
+
+def on_starting(server):
+    if workers > 1 and not os.getenv("REDIS_URL"):
+        server.log.warning("Running %d workers without REDIS_URL: duplicate webhook deliveries "
+                           "are only caught when they reach the same worker", workers)
@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Protocol
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+def cache_key(model, prompt, temperature):
+    # prompt may be a string or a list of chat messages; both serialize deterministically.
+    payload = orjson.dumps({"m": model, "p": prompt, "t": temperature}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+class CacheBackend(Protocol):
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str) -> None: ...
+
+
+class LRUBackend:
+    """In-process cache; entries are evicted least-recently-used once maxsize is reached."""
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class RedisBackend:
+    """Cache shared across workers; entries expire after ttl seconds.
+
+    The cache is an optimization, so Redis errors are logged and treated as a
+    miss (get) or skipped (set) instead of failing the caller.
+    """
+
+    def __init__(self, client, ttl=7 * 86400, prefix="llm:"):
+        from redis import RedisError
+
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._errors = RedisError
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except self._errors as e:
+            logger.warning("Redis cache get failed, treating as a miss: %s", e)
+            return None
+        return value.decode() if value is not None else None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, value, ex=self.ttl)
+        except self._errors as e:
+            logger.warning("Redis cache set failed, skipping: %s", e)
+
+
+class LLMCache:
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def stats(self):
+        return {"backend": type(self.backend).__name__, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,36 @@
+import msgspec
+
+
+# Only the fields the webhook reads are declared; msgspec skips everything else in
+# the (often 100+ KB) pull_request payload without allocating it.
+class Owner(msgspec.Struct):
+    login: str
+
+
+class Repository(msgspec.Struct):
+    id: int
+    name: str
+    owner: Owner
+
+
+class Base(msgspec.Struct):
+    repo: Repository
+
+
+class Head(msgspec.Struct):
+    sha: str
+
+
+class PullRequest(msgspec.Struct):
+    number: int
+    node_id: str
+    head: Head
+    base: Base
+
+
+class PullRequestEvent(msgspec.Struct):
+    action: str
+    pull_request: PullRequest
+
+
+pull_request_event_decoder = msgspec.json.Decoder(PullRequestEvent)
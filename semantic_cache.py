@@ -0,0 +1,151 @@
+import fcntl
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Hunk headers and blob indexes change on every rebase without changing meaning.
+DIFF_NOISE_RE = re.compile(r'^(@@ |index [0-9a-f]+\.\.[0-9a-f]+)')
+# File markers, only noise in a file header: in a hunk "--- x" is a removed "-- x" line.
+FILE_MARKER_RE = re.compile(r'^(--- |\+\+\+ )')
+WHITESPACE_RE = re.compile(r'\s+')
+
+# all-MiniLM-L6-v2 truncates its input at 256 word pieces. Code splits into far more
+# pieces per character than prose, so windows stay well short of that.
+WINDOW_CHARS = 512
+# How many nearest first windows to check before giving up on a hit.
+CANDIDATES = 8
+
+
+def normalize_diff(diff_text):
+    kept = []
+    in_header = False
+    for line in diff_text.splitlines():
+        if line.startswith("diff --git "):
+            in_header = True
+        elif line.startswith("@@"):
+            in_header = False
+        if DIFF_NOISE_RE.match(line) or (in_header and FILE_MARKER_RE.match(line)):
+            continue
+        kept.append(line)
+    return WHITESPACE_RE.sub(" ", "\n".join(kept)).strip()
+
+
+def split_windows(text):
+    return [text[i:i + WINDOW_CHARS] for i in range(0, len(text), WINDOW_CHARS)] or [""]
+
+
+class SemanticCache:
+    """Returns a stored summary when a new diff embeds close enough to one seen before.
+
+    Needs the optional ``fastembed`` and ``faiss-cpu`` packages. Vectors are
+    L2-normalized, so inner product on a ``faiss.IndexFlatIP`` is cosine similarity.
+    A diff is embedded as consecutive windows that each fit the model, and a hit
+    needs every window to match its counterpart in the stored entry. Hits are
+    limited to summaries written by the same LLM, and a saved file written under
+    another prompt_version is discarded.
+    """
+
+    def __init__(self, threshold=0.92, index_path=None, persist_every=50, prompt_version="",
+                 model_name="sentence-transformers/all-MiniLM-L6-v2"):
+        import faiss
+        import numpy
+        from fastembed import TextEmbedding
+
+        self.threshold = threshold
+        self.index_path = index_path
+        self.persist_every = persist_every
+        self.prompt_version = prompt_version
+        self._faiss = faiss
+        self._np = numpy
+        self._model = TextEmbedding(model_name)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.index = None
+        # (first index row, window count, LLM, summary) per cached diff.
+        self.entries = []
+        self._row_entry = []
+        if index_path and os.path.exists(index_path):
+            try:
+                self.index, entries = self._read()
+            except Exception as e:
+                logger.warning("Ignoring semantic cache %s: %s", index_path, e)
+            else:
+                for count, llm, summary in entries:
+                    self._add_entry(count, llm, summary)
+                logger.info("Loaded semantic cache with %d entries", len(self.entries))
+
+    def embed(self, text):
+        windows = split_windows(normalize_diff(text))
+        vectors = self._np.array(list(self._model.embed(windows)), dtype="float32")
+        self._faiss.normalize_L2(vectors)
+        return vectors
+
+    def lookup(self, vectors, llm):
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            scores, rows = self.index.search(vectors[:1], min(CANDIDATES, self.index.ntotal))
+            for score, row in zip(scores[0], rows[0]):
+                if score < self.threshold:
+                    break
+                start, count, entry_llm, summary = self.entries[self._row_entry[row]]
+                if row != start or count != len(vectors) or entry_llm != llm:
+                    continue
+                if count > 1:
+                    stored = self.index.reconstruct_n(start + 1, count - 1)
+                    if (stored * vectors[1:]).sum(axis=1).min() < self.threshold:
+                        continue
+                logger.debug("Semantic cache hit, similarity=%.3f", score)
+                return summary
+            return None
+
+    def add(self, vectors, llm, summary):
+        with self._lock:
+            if self.index is None:
+                self.index = self._faiss.IndexFlatIP(vectors.shape[1])
+            self.index.add(vectors)
+            self._add_entry(len(vectors), llm, summary)
+            self._pending += 1
+            if self.index_path and self._pending >= self.persist_every:
+                self._persist()
+
+    def _add_entry(self, count, llm, summary):
+        self._row_entry.extend([len(self.entries)] * count)
+        self.entries.append((len(self._row_entry) - count, count, llm, summary))
+
+    def _read(self):
+        with self._np.load(self.index_path) as data:
+            prompt_version = str(data["prompt_version"]) if "prompt_version" in data else None
+            if prompt_version != self.prompt_version:
+                raise ValueError(f"written for prompt version {prompt_version}, not {self.prompt_version}")
+            index = self._faiss.deserialize_index(data["index"])
+            entries = list(zip(data["counts"].tolist(), data["llms"].tolist(), data["summaries"].tolist()))
+        if index.ntotal != sum(count for count, _, _ in entries):
+            raise ValueError("index and summaries disagree")
+        return index, entries
+
+    def _persist(self):
+        # Every worker saves to the same file. Take turns under a lock, keep what the
+        # others saved, and swap a complete file into place so readers never see half of one.
+        # A file from an older prompt version fails to read and is replaced.
+        with open(self.index_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index, entries = self._read()
+            except Exception:
+                index, entries = self._faiss.IndexFlatIP(self.index.d), []
+            for start, count, llm, summary in self.entries[len(self.entries) - self._pending:]:
+                index.add(self.index.reconstruct_n(start, count))
+                entries.append((count, llm, summary))
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                self._np.savez(f, prompt_version=self._np.array(self.prompt_version),
+                               index=self._faiss.serialize_index(index),
+                               counts=self._np.array([count for count, _, _ in entries]),
+                               llms=self._np.array([llm for _, llm, _ in entries]),
+                               summaries=self._np.array([summary for _, _, summary in entries]))
+            os.replace(tmp_path, self.index_path)
+        self._pending = 0
@@ -0,0 +1,39 @@
+import unittest
+
+from app import is_whitespace_only, strip_ignorable_files
+
+HEADER = "diff --git a/auth.py b/auth.py\nindex 1234abc..5678def 100644\n--- a/auth.py\n+++ b/auth.py\n"
+
+
+class IsWhitespaceOnlyTest(unittest.TestCase):
+    def test_moved_line_is_a_change(self):
+        diff = HEADER + (
+            "@@ -1,2 +1,2 @@\n"
+            "-    check_permission(req.user)\n"
+            "     delete_account(req.user)\n"
+            "+    check_permission(req.user)\n"
+        )
+        self.assertFalse(is_whitespace_only(diff))
+        self.assertEqual(strip_ignorable_files(diff), (diff, 0.0))
+
+    def test_swapped_lines_are_a_change(self):
+        diff = HEADER + (
+            "@@ -1,2 +1,2 @@\n"
+            "-    check_permission(req.user)\n"
+            "-    delete_account(req.user)\n"
+            "+    delete_account(req.user)\n"
+            "+    check_permission(req.user)\n"
+        )
+        self.assertFalse(is_whitespace_only(diff))
+
+    def test_indentation_change_is_a_change(self):
+        diff = HEADER + "@@ -1 +1 @@\n-return x\n+    return x\n"
+        self.assertFalse(is_whitespace_only(diff))
+
+    def test_trailing_whitespace_is_ignored(self):
+        diff = HEADER + "@@ -1,2 +1,2 @@\n-    return x  \n+    return x\n     pass\n"
+        self.assertTrue(is_whitespace_only(diff))
+
+
+if __name__ == "__main__":
+    unittest.main()